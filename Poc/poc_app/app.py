@@ -1,5 +1,4 @@
 import os
-import pandas as pd
 from flask import Flask, render_template, request, redirect, url_for, session
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename # Import secure_filename
@@ -12,7 +11,7 @@ os.makedirs(db_dir, exist_ok=True)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SECRET_KEY"] = "your_secret_key_here" # IMPORTANT: Change this to a strong random key in production!
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "your_secret_key_here") # IMPORTANT: Set SECRET_KEY to a strong random key in production!
 db = SQLAlchemy(app)
 
 # --- モデル定義 ---
@@ -43,6 +42,7 @@ def upload_bom():
     db.session.query(BomLine).delete()
 
     try:
+        import pandas as pd # Imported here so that starting the app does not load pandas
         df = pd.read_csv(file)
         for _, row in df.iterrows():
             references_str = str(row.get("Reference", "")).strip()
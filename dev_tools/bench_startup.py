@@ -0,0 +1,42 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# parts_manager の起動時間（import + create_app）を新しいプロセスで計測する
+#   python dev_tools/bench_startup.py [回数]
+
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "parts_manager")
+HEAVY_MODULES = ("qrcode", "PIL", "alembic", "flask_migrate", "pandas")
+
+BOOT_SCRIPT = f"""
+import sys, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+booted = time.perf_counter()
+loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(imported - start, booted - start, ",".join(loaded))
+"""
+
+def measure(runs):
+    import_times, boot_times = [], []
+    loaded = ""
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", BOOT_SCRIPT],
+            cwd=PROJECT_ROOT, capture_output=True, text=True, check=True,
+        )
+        import_time, boot_time, loaded = result.stdout.split(" ", 2)
+        import_times.append(float(import_time))
+        boot_times.append(float(boot_time))
+    return import_times, boot_times, loaded.strip()
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    import_times, boot_times, loaded = measure(runs)
+    print(f"runs: {runs}")
+    print(f"import     median {statistics.median(import_times) * 1000:.1f} ms  (min {min(import_times) * 1000:.1f} ms)")
+    print(f"create_app median {statistics.median(boot_times) * 1000:.1f} ms  (min {min(boot_times) * 1000:.1f} ms)")
+    print(f"heavy modules loaded: {loaded or 'none'}")
@@ -1,31 +1,67 @@
 import os
+import secrets
 from flask import Flask
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
-def create_app():
-    app = Flask(__name__)
+def _load_secret_key(app):
+    """インスタンスフォルダに保存した秘密鍵を返す。なければ作成する
+
+    すべてのワーカーが同じ鍵を使うので、flash などのセッションがワーカーをまたいでも有効になる。
+    """
+    path = os.path.join(app.instance_path, 'secret_key')
+    if not os.path.exists(path):
+        os.makedirs(app.instance_path, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}'
+        # 署名鍵なので所有者だけが読めるように作る
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            # 同時に起動したワーカーと競合しても、最初に作られた鍵だけが残る
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+def create_app(instance_path=None):
+    app = Flask(__name__, instance_path=instance_path)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///../instance/parts.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # FLASK_SECRET_KEY, FLASK_PRELOAD_QR などの環境変数で上書きできる
+    app.config.from_prefixed_env()
+
+    if not app.secret_key:
+        app.secret_key = _load_secret_key(app)
 
-    app.secret_key = os.urandom(24)
-    
     db.init_app(app)
-    migrations_dir = os.path.join(os.path.dirname(app.root_path), 'migrations')
-    Migrate(app, db, directory=migrations_dir)
+    # Flask-Migrate は alembic ごと読み込まれて重いため、flask コマンド実行時だけ登録する
+    if app.config.get('MIGRATE', os.environ.get('FLASK_RUN_FROM_CLI') == 'true'):
+        from flask_migrate import Migrate
+        migrations_dir = os.path.join(os.path.dirname(app.root_path), 'migrations')
+        Migrate(app, db, directory=migrations_dir)
+
+    # gunicorn --preload で fork 前に重いモジュールを読み込んでおく場合に使う
+    if app.config.get('PRELOAD_QR'):
+        from .qr import warm_up
+        warm_up()
 
-    from .models import Part, Tag
+    from .models import Part, Tag, PartTombstone
 
     from .routes.main_routes import main_bp
     from .routes.parts_routes import parts_bp
     from .routes.tags_routes import tags_bp
     from .routes.labels_routes import labels_bp
+    from .routes.sync_routes import sync_bp
 
     app.register_blueprint(main_bp)
     app.register_blueprint(parts_bp)
     app.register_blueprint(tags_bp)
     app.register_blueprint(labels_bp)
+    app.register_blueprint(sync_bp)
 
     return app
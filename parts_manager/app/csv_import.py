@@ -0,0 +1,189 @@
+import csv
+import io
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from flask import current_app, request
+from . import db
+from .models import Part, Tag, ImportJob
+from .qr import save_qr_code
+
+# 何行ごとにコミットして進捗・キャンセルを確認するか
+BATCH_SIZE = 200
+# ハートビートがこの秒数途絶えたジョブは、ワーカーごと止まったとみなす
+STALE_SECONDS = 300
+
+def start_import(file):
+    """アップロードされたCSVをディスクに退避し、取り込みジョブを登録して開始する
+
+    CSV_IMPORT_ASYNC が False（テスト時の既定）の場合はその場で取り込みを終えてから返す。
+    """
+    fd, path = tempfile.mkstemp(prefix='parts_import_', suffix='.csv')
+    with os.fdopen(fd, 'wb') as spool:
+        file.save(spool)
+
+    job = ImportJob(filename=file.filename, total_bytes=os.path.getsize(path), spool_path=path)
+    db.session.add(job)
+    db.session.commit()
+    job_id = job.id
+
+    app = current_app._get_current_object()
+    if app.config.get('CSV_IMPORT_ASYNC', not app.testing):
+        threading.Thread(
+            target=run_import_job,
+            # url_root はマウント先のパス（SCRIPT_NAME）も含む
+            args=(app, job_id, path, request.url_root),
+            daemon=True,
+        ).start()
+    else:
+        import_csv(job_id, path)
+    return job_id
+
+def run_import_job(app, job_id, path, base_url):
+    """別スレッドでジョブを実行する。QRコードのURL生成のためリクエストコンテキストを用意する"""
+    with app.test_request_context(base_url=base_url):
+        try:
+            import_csv(job_id, path)
+        finally:
+            db.session.remove()
+
+def import_csv(job_id, path):
+    """退避したCSVを取り込み、終わったら一時ファイルを削除する"""
+    try:
+        _import_rows(job_id, path)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ImportJob, job_id)
+        job.status = 'failed'
+        job.add_error(f'エラーが発生しました: {e}')
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    finally:
+        _remove_file(path)
+
+def fail_if_stale(job):
+    """ハートビートが途絶えた未完了ジョブを失敗扱いにし、一時ファイルを片付ける
+
+    ワーカーの再起動・タイムアウトで取り込みスレッドごと止まった場合に、
+    ジョブが実行中のまま残らないようにする。
+    """
+    if job.finished:
+        return
+    stale_after = timedelta(seconds=current_app.config.get('CSV_IMPORT_STALE_SECONDS', STALE_SECONDS))
+    if job.updated_at and datetime.utcnow() - job.updated_at < stale_after:
+        return
+    job.add_error('取り込み処理が応答しなくなったため中断しました')
+    _remove_file(job.spool_path)
+    _finish(job, 'failed')
+
+def _import_rows(job_id, path):
+    job = db.session.get(ImportJob, job_id)
+    if job.cancel_requested:
+        _finish(job, 'cancelled')
+        return
+    job.status = 'running'
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    tags = {}  # タグ名 -> Tag（ジョブ内で使い回して行ごとの検索を避ける）
+    batch = []
+    rows_read = 0
+    with open(path, 'rb') as raw:
+        # ファイル全体を読み込まず、1行ずつデコードする
+        reader = csv.DictReader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+        for row in reader:
+            # line_num は改行を含むフィールドがあっても実際の行番号を指す
+            part = _build_part(job, row, reader.line_num, tags)
+            if part is not None:
+                batch.append(part)
+            rows_read += 1
+            if rows_read % BATCH_SIZE == 0:
+                if not _commit_batch(job, batch, raw.tell()):
+                    return
+                batch = []
+
+    if _commit_batch(job, batch, job.total_bytes):
+        _finish(job, 'done')
+
+def _build_part(job, row, line_no, tags):
+    name = (row.get('name') or '').strip()
+    if not name:
+        job.add_error(f'{line_no}行目: 部品名がありません')
+        return None
+    try:
+        quantity = int(row.get('quantity') or 0)
+    except ValueError:
+        job.add_error(f'{line_no}行目: 在庫数が不正です ({row.get("quantity")})')
+        return None
+
+    new_part = Part(
+        name=name,
+        category=row.get('category'),
+        package=row.get('package'),
+        quantity=quantity,
+        location=row.get('location'),
+        note=row.get('note')
+    )
+    db.session.add(new_part)
+    # タグ検索のたびに自動フラッシュして、書き込みロックを早く取らないようにする
+    with db.session.no_autoflush:
+        for tag_name in (row.get('tags') or '').split(','):
+            tag_name = tag_name.strip()
+            if tag_name:
+                tag = _get_tag(tag_name, tags)
+                if tag not in new_part.tags:
+                    new_part.tags.append(tag)
+    return new_part
+
+def _commit_batch(job, parts, processed_bytes):
+    """バッチを確定し、QRコードを生成して進捗とハートビートを記録する
+
+    SQLiteの書き込みロックを画像生成の間保持しないよう、部品を先にコミットしてから
+    QRコードを作る。続くコミットが失敗した場合は、このバッチで作った画像を削除する。
+    継続してよければ True を返す。
+    """
+    db.session.commit()
+
+    saved = []
+    try:
+        for part in parts:
+            saved.append(save_qr_code(part))
+        job.rows_done += len(parts)
+        job.processed_bytes = processed_bytes
+        job.updated_at = datetime.utcnow()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for path in saved:
+            _remove_file(path)
+        raise
+
+    # コミット後の再読込で、別リクエストからのキャンセル要求や停止判定が見える
+    if job.cancel_requested:
+        _finish(job, 'cancelled')
+        return False
+    return job.status == 'running'
+
+def _get_tag(name, tags):
+    tag = tags.get(name)
+    if tag is None:
+        tag = Tag.query.filter_by(name=name).first()
+        if tag is None:
+            tag = Tag(name=name)
+            db.session.add(tag)
+        tags[name] = tag
+    return tag
+
+def _remove_file(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _finish(job, status):
+    job.status = status
+    job.finished_at = datetime.utcnow()
+    job.updated_at = job.finished_at
+    db.session.commit()
@@ -1,9 +1,12 @@
+import uuid
 from . import db
 from datetime import datetime
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
 
 part_tag = db.Table('part_tag',
-    db.Column('part_id', db.Integer, db.ForeignKey('part.id')),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'))
+    db.Column('part_id', db.Integer, db.ForeignKey('part.id'), index=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), index=True)
 )
 
 class Part(db.Model):
@@ -17,8 +20,153 @@ class Part(db.Model):
     image_path = db.Column(db.String(200))
     qr_path = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # 変更フィード用のリビジョン番号（書き込みのたびに before_flush で採番）
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
     tags = db.relationship('Tag', secondary=part_tag, backref='parts')
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'category': self.category,
+            'package': self.package,
+            'quantity': self.quantity,
+            'location': self.location,
+            'note': self.note,
+            'image_path': self.image_path,
+            'qr_path': self.qr_path,
+            'tags': sorted(tag.name for tag in self.tags),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'revision': self.revision,
+        }
+
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True)
+
+class PartTombstone(db.Model):
+    """削除された部品の記録。オフライン端末に削除を伝えるために残す"""
+    id = db.Column(db.Integer, primary_key=True)
+    part_id = db.Column(db.Integer, nullable=False, index=True)
+    revision = db.Column(db.Integer, nullable=False, index=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RevisionCounter(db.Model):
+    """変更フィードのリビジョン番号を採番する1行だけのテーブル"""
+    __tablename__ = 'rev_counter'
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class ImportJob(db.Model):
+    """CSV一括登録のバックグラウンドジョブ。進捗はワーカーをまたいで参照できるようDBに持つ"""
+    MAX_ERROR_MESSAGES = 100
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    filename = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending / running / done / failed / cancelled
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text, nullable=False, default='')
+    total_bytes = db.Column(db.Integer, nullable=False, default=0)
+    processed_bytes = db.Column(db.Integer, nullable=False, default=0)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    spool_path = db.Column(db.String(500))  # アップロードを退避した一時ファイル
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # ハートビート。実行中のジョブはバッチごとに更新する
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    @property
+    def error_messages(self):
+        return self.errors.splitlines() if self.errors else []
+
+    def add_error(self, message):
+        self.error_count = (self.error_count or 0) + 1
+        # メッセージは先頭の一定件数だけ保存する
+        if self.error_count <= self.MAX_ERROR_MESSAGES:
+            self.errors = (self.errors or '') + message + '\n'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'rows_done': self.rows_done,
+            'error_count': self.error_count,
+            'errors': self.error_messages,
+            'total_bytes': self.total_bytes,
+            'processed_bytes': self.processed_bytes,
+            'cancel_requested': self.cancel_requested,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+def next_revision(session):
+    """リビジョン番号を1つ進めて返す
+
+    最初にカウンタ行を UPDATE して書き込みロックを取ってから値を読むので、
+    並行する書き込みでも番号は重複せず、コミット順に増えていく。
+    """
+    counter = RevisionCounter.__table__
+    result = session.execute(
+        counter.update().where(counter.c.id == 1).values(value=counter.c.value + 1)
+    )
+    if result.rowcount == 0:
+        # カウンタ行がまだない場合は、既存データの最大値の次から始める
+        current = max(
+            session.query(func.max(Part.revision)).scalar() or 0,
+            session.query(func.max(PartTombstone.revision)).scalar() or 0,
+        )
+        session.execute(counter.insert().values(id=1, value=current + 1))
+    return session.execute(db.select(counter.c.value).where(counter.c.id == 1)).scalar_one()
+
+def touch_parts(session, part_ids):
+    """一括SQLで変更した部品のリビジョンを進める（ORMのイベントを通らないため）
+
+    part_ids にはIDのリストか、部品IDを返すSELECTを渡す。
+    """
+    session.execute(
+        db.update(Part)
+        .where(Part.id.in_(part_ids))
+        .values(revision=next_revision(session), updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_part_changes(session, flush_context, instances):
+    # 追加・変更された部品（タグの付け替えを含む）
+    changed = {obj for obj in session.new if isinstance(obj, Part)}
+    changed.update(
+        obj for obj in session.dirty
+        if isinstance(obj, Part) and session.is_modified(obj)
+    )
+    # タグ名の変更・タグ削除は、そのタグが付いた部品の変更として扱う
+    for obj in session.dirty:
+        if isinstance(obj, Tag) and db.inspect(obj).attrs.name.history.has_changes():
+            changed.update(obj.parts)
+    for obj in session.deleted:
+        if isinstance(obj, Tag):
+            changed.update(obj.parts)
+
+    deleted = [obj for obj in session.deleted if isinstance(obj, Part)]
+    changed.difference_update(deleted)
+    if not changed and not deleted:
+        return
+
+    # 1回のフラッシュ内の変更はすべて同じリビジョンにまとめる
+    revision = next_revision(session)
+    now = datetime.utcnow()
+    for part in changed:
+        part.revision = revision
+        part.updated_at = now
+    for part in deleted:
+        session.add(PartTombstone(part_id=part.id, revision=revision, deleted_at=now))
@@ -0,0 +1,42 @@
+import os
+import time
+from flask import url_for, current_app
+
+QR_UPLOAD_FOLDER = 'static/qr'
+
+def warm_up():
+    """qrcode と Pillow を読み込んでおく
+
+    gunicorn の --preload などで fork 前に呼べば、各ワーカーは読み込み済みのモジュールを共有できる。
+    """
+    # 読み込むこと自体が目的なので、名前を使わなくても削除しないこと
+    import qrcode
+    import qrcode.image.pil
+    import PIL.Image
+    import PIL.PngImagePlugin
+
+def save_qr_code(part):
+    """部品詳細ページのURLをQRコード画像として保存し、part.qr_path を設定する
+
+    保存した画像ファイルの絶対パスを返す。
+    """
+    # qrcode は Pillow ごと読み込まれて重いため、起動時ではなく初回使用時に読み込む
+    import qrcode
+
+    qr_data = url_for('parts.part_detail', part_id=part.id, _external=True)
+    qr_filename = f'part_{part.id}_{int(time.time())}.png'
+    qr_save_path = os.path.join(current_app.root_path, QR_UPLOAD_FOLDER, qr_filename)
+
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    img.save(qr_save_path)
+    part.qr_path = os.path.join(QR_UPLOAD_FOLDER.split('/', 1)[1], qr_filename).replace('\\', '/')
+    return qr_save_path
@@ -1,21 +1,23 @@
 # app/routes/parts_routes.py
 
 import os
-import time
-import qrcode
-import csv
 from werkzeug.utils import secure_filename
-from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app
-from ..models import db, Part, Tag
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, jsonify
+from sqlalchemy import exists, select, true
+from ..models import db, Part, Tag, ImportJob, part_tag, touch_parts
+from ..csv_import import start_import, fail_if_stale
+from ..qr import save_qr_code
 
 UPLOAD_FOLDER = 'static/images'
-QR_UPLOAD_FOLDER = 'static/qr'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'csv'}
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _selected_ids(field):
+    return [int(value) for value in request.form.getlist(field) if value.isdigit()]
+
 parts_bp = Blueprint('parts', __name__, url_prefix='/parts')
 
 @parts_bp.route('/new', methods=['GET', 'POST'])
@@ -28,7 +30,7 @@ def part_create():
         quantity = request.form.get('quantity', 0)
         location = request.form.get('location')
         note = request.form.get('note')
-        selected_tag_ids = request.form.getlist('tags')
+        selected_tag_ids = _selected_ids('tags')
 
         new_part = Part(
             name=name,
@@ -53,28 +55,11 @@ def part_create():
         db.session.commit()
 
         # QRコードの生成と保存
-        qr_data = url_for('parts.part_detail', part_id=new_part.id, _external=True)
-        qr_filename = f'part_{new_part.id}_{int(time.time())}.png'
-        qr_save_path = os.path.join(current_app.root_path, QR_UPLOAD_FOLDER, qr_filename)
-        
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
+        save_qr_code(new_part)
 
-        img = qr.make_image(fill_color="black", back_color="white")
-        img.save(qr_save_path)
-        new_part.qr_path = os.path.join(QR_UPLOAD_FOLDER.split('/', 1)[1], qr_filename).replace('\\', '/')
-
-        # タグの関連付け
-        for tag_id in selected_tag_ids:
-            tag = Tag.query.get(tag_id)
-            if tag:
-                new_part.tags.append(tag)
+        # タグの関連付け（選択されたタグを1回のクエリで取得）
+        if selected_tag_ids:
+            new_part.tags = Tag.query.filter(Tag.id.in_(selected_tag_ids)).all()
 
         db.session.commit()
 
@@ -122,7 +107,7 @@ def part_edit(part_id):
         part.quantity = request.form.get('quantity', type=int, default=0)
         part.location = request.form.get('location')
         part.note = request.form.get('note')
-        selected_tag_ids = request.form.getlist('tags')
+        selected_tag_ids = _selected_ids('tags')
 
         # 画像ファイルの処理
         if 'image_file' in request.files:
@@ -139,29 +124,13 @@ def part_edit(part_id):
                 part.image_path = None
 
         # QRコードの生成と保存 (編集時)
-        qr_data = url_for('parts.part_detail', part_id=part.id, _external=True)
-        qr_filename = f'part_{part.id}_{int(time.time())}.png'
-        qr_save_path = os.path.join(current_app.root_path, QR_UPLOAD_FOLDER, qr_filename)
-        
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(qr_data)
-        qr.make(fit=True)
+        save_qr_code(part)
 
-        img = qr.make_image(fill_color="black", back_color="white")
-        img.save(qr_save_path)
-        part.qr_path = os.path.join(QR_UPLOAD_FOLDER.split('/', 1)[1], qr_filename).replace('\\', '/')
-
-        # 既存のタグ関連付けをクリアして再設定
-        part.tags.clear()
-        for tag_id in selected_tag_ids:
-            tag = Tag.query.get(tag_id)
-            if tag:
-                part.tags.append(tag)
+        # タグ関連付けを再設定（差分だけが part_tag に書き込まれる）
+        if selected_tag_ids:
+            part.tags = Tag.query.filter(Tag.id.in_(selected_tag_ids)).all()
+        else:
+            part.tags = []
 
         db.session.commit()
         flash('部品情報を更新しました！', 'success')
@@ -182,6 +151,39 @@ def part_delete(part_id):
     flash('部品を削除しました。', 'success')
     return redirect(url_for('parts.parts_list'))
 
+@parts_bp.route('/tags/bulk', methods=['POST'])
+def bulk_tags():
+    """選択した部品にまとめてタグを付与・解除する"""
+    action = request.form.get('action')
+    part_ids = _selected_ids('part_ids')
+    tag_ids = _selected_ids('tag_ids')
+
+    if action not in ('add', 'remove') or not part_ids or not tag_ids:
+        flash('部品とタグを選択してください。', 'error')
+        return redirect(request.referrer or url_for('parts.parts_list'))
+
+    if action == 'add':
+        # まだ付いていない (部品, タグ) の組み合わせだけを INSERT ... SELECT で追加
+        linked = part_tag.alias()
+        missing = (
+            select(Part.id, Tag.id)
+            .join_from(Part, Tag, true())
+            .where(Part.id.in_(part_ids), Tag.id.in_(tag_ids))
+            .where(~exists().where(linked.c.part_id == Part.id, linked.c.tag_id == Tag.id))
+        )
+        touch_parts(db.session, select(missing.subquery().c[0]))
+        db.session.execute(part_tag.insert().from_select(['part_id', 'tag_id'], missing))
+        message = 'タグを一括で付与しました。'
+    else:
+        affected = part_tag.c.part_id.in_(part_ids) & part_tag.c.tag_id.in_(tag_ids)
+        touch_parts(db.session, select(part_tag.c.part_id).where(affected))
+        db.session.execute(part_tag.delete().where(affected))
+        message = 'タグを一括で解除しました。'
+
+    db.session.commit()
+    flash(message, 'success')
+    return redirect(request.referrer or url_for('parts.parts_list'))
+
 @parts_bp.route('/<int:part_id>/update_quantity', methods=['POST'])
 def update_quantity(part_id):
     part = Part.query.get_or_404(part_id)
@@ -213,60 +215,40 @@ def upload_csv():
             return redirect(request.url)
         
         if file and allowed_file(file.filename):
-            try:
-                # ストリームから直接CSVを読み込む
-                csv_file = file.stream.read().decode('utf-8-sig').splitlines()
-                csv_reader = csv.DictReader(csv_file)
-                
-                for row in csv_reader:
-                    # 新しいPartオブジェクトを作成
-                    new_part = Part(
-                        name=row.get('name'),
-                        category=row.get('category'),
-                        package=row.get('package'),
-                        quantity=int(row.get('quantity', 0)),
-                        location=row.get('location'),
-                        note=row.get('note')
-                    )
-                    
-                    db.session.add(new_part)
-                    db.session.commit() # IDを取得するためにコミット
-
-                    # QRコードの生成
-                    qr_data = url_for('parts.part_detail', part_id=new_part.id, _external=True)
-                    qr_filename = f'part_{new_part.id}_{int(time.time())}.png'
-                    qr_save_path = os.path.join(current_app.root_path, QR_UPLOAD_FOLDER, qr_filename)
-                    
-                    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-                    qr.add_data(qr_data)
-                    qr.make(fit=True)
-                    img = qr.make_image(fill_color="black", back_color="white")
-                    img.save(qr_save_path)
-                    new_part.qr_path = os.path.join(QR_UPLOAD_FOLDER.split('/', 1)[1], qr_filename).replace('\\', '/')
-
-                    # タグの処理
-                    if 'tags' in row and row['tags']:
-                        tag_names = [tag.strip() for tag in row['tags'].split(',')]
-                        for tag_name in tag_names:
-                            if not tag_name:
-                                continue
-                            tag = Tag.query.filter_by(name=tag_name).first()
-                            if not tag:
-                                tag = Tag(name=tag_name)
-                                db.session.add(tag)
-                                db.session.commit() # 新しいタグを保存
-                            new_part.tags.append(tag)
-                
-                db.session.commit()
+            # アップロードはディスクに退避し、取り込みはバックグラウンドジョブで行う
+            job_id = start_import(file)
+            job = db.session.get(ImportJob, job_id)
+            if not job.finished:
+                flash('CSVファイルの取り込みを開始しました。', 'info')
+                return redirect(url_for('parts.import_job', job_id=job_id))
+            if job.status == 'done' and not job.error_count:
                 flash('CSVファイルから部品が一括登録されました！', 'success')
                 return redirect(url_for('parts.parts_list'))
-
-            except Exception as e:
-                db.session.rollback()
-                flash(f'エラーが発生しました: {e}', 'error')
-                return redirect(request.url)
+            return redirect(url_for('parts.import_job', job_id=job_id))
         else:
             flash('許可されていないファイル形式です', 'error')
             return redirect(request.url)
             
-    return render_template('parts/upload.html')
\ No newline at end of file
+    return render_template('parts/upload.html')
+
+@parts_bp.route('/upload/jobs/<job_id>')
+def import_job(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    fail_if_stale(job)
+    return render_template('parts/import_job.html', job=job)
+
+@parts_bp.route('/upload/jobs/<job_id>/status')
+def import_job_status(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    fail_if_stale(job)
+    return jsonify(job.to_dict())
+
+@parts_bp.route('/upload/jobs/<job_id>/cancel', methods=['POST'])
+def import_job_cancel(job_id):
+    job = ImportJob.query.get_or_404(job_id)
+    fail_if_stale(job)
+    if not job.finished:
+        job.cancel_requested = True
+        db.session.commit()
+        flash('取り込みのキャンセルを要求しました。', 'warning')
+    return redirect(url_for('parts.import_job', job_id=job_id))
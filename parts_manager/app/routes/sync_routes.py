@@ -0,0 +1,71 @@
+from flask import Blueprint, request, jsonify
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
+from ..models import Part, PartTombstone
+
+sync_bp = Blueprint('sync', __name__)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def parse_cursor(cursor):
+    """カーソル文字列 '<revision>:<part_id>' を (revision, part_id) に変換する"""
+    if not cursor:
+        # 初回同期: リビジョン0の既存データも含めて全件を返す
+        return -1, 0
+    revision, _, part_id = cursor.partition(':')
+    return int(revision), int(part_id or 0)
+
+
+def format_cursor(revision, part_id):
+    return f'{revision}:{part_id}'
+
+
+def _after(revision_col, id_col, revision, part_id):
+    # (revision, id) > (カーソル) の条件。revision のインデックスで絞り込める形にする
+    return or_(
+        revision_col > revision,
+        and_(revision_col == revision, id_col > part_id),
+    )
+
+
+@sync_bp.route('/changes')
+def changes():
+    try:
+        revision, part_id = parse_cursor(request.args.get('since', ''))
+    except ValueError:
+        return jsonify(error='invalid cursor'), 400
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    # 部品・削除記録それぞれ limit+1 件まで取得してマージする
+    parts = (Part.query
+             .options(selectinload(Part.tags))
+             .filter(_after(Part.revision, Part.id, revision, part_id))
+             .order_by(Part.revision, Part.id)
+             .limit(limit + 1)
+             .all())
+    tombstones = (PartTombstone.query
+                  .filter(_after(PartTombstone.revision, PartTombstone.part_id, revision, part_id))
+                  .order_by(PartTombstone.revision, PartTombstone.part_id)
+                  .limit(limit + 1)
+                  .all())
+
+    entries = [(p.revision, p.id, 1, {'type': 'upsert', 'part': p.to_dict()}) for p in parts]
+    entries += [(t.revision, t.part_id, 0, {'type': 'delete', 'id': t.part_id, 'revision': t.revision})
+                for t in tombstones]
+    entries.sort(key=lambda e: e[:3])
+
+    has_more = len(entries) > limit
+    page = entries[:limit]
+    if page:
+        next_cursor = format_cursor(page[-1][0], page[-1][1])
+    else:
+        next_cursor = request.args.get('since', '') or format_cursor(0, 0)
+
+    return jsonify(
+        changes=[e[3] for e in page],
+        next_cursor=next_cursor,
+        has_more=has_more,
+    )
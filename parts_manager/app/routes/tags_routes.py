@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from ..models import db, Tag
+from sqlalchemy import select
+from ..models import db, Tag, part_tag, touch_parts
 
 tags_bp = Blueprint('tags', __name__, url_prefix='/tags')
 
@@ -48,3 +49,30 @@ def tag_delete(tag_id):
     db.session.commit()
     flash('タグを削除しました。', 'success')
     return redirect(url_for('tags.tag_list'))
+
+@tags_bp.route('/<int:tag_id>/merge', methods=['POST'])
+def tag_merge(tag_id):
+    """タグ tag_id を統合先のタグにまとめて削除する"""
+    source = Tag.query.get_or_404(tag_id)
+    target_id = request.form.get('target_id', type=int)
+    target = db.session.get(Tag, target_id) if target_id else None
+    if target is None or target.id == source.id:
+        flash('統合先のタグを選択してください。', 'error')
+        return redirect(url_for('tags.tag_list'))
+
+    source_links = select(part_tag.c.part_id).where(part_tag.c.tag_id == source.id)
+    target_links = select(part_tag.c.part_id).where(part_tag.c.tag_id == target.id)
+
+    touch_parts(db.session, source_links)
+    # 統合先が未設定の部品の関連付けを1文で付け替え、残った重複は削除する
+    db.session.execute(
+        part_tag.update()
+        .where(part_tag.c.tag_id == source.id, part_tag.c.part_id.not_in(target_links))
+        .values(tag_id=target.id)
+    )
+    db.session.execute(part_tag.delete().where(part_tag.c.tag_id == source.id))
+    db.session.execute(db.delete(Tag).where(Tag.id == source.id))
+    message = f'タグ「{source.name}」を「{target.name}」に統合しました。'
+    db.session.commit()
+    flash(message, 'success')
+    return redirect(url_for('tags.tag_list'))
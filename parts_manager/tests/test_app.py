@@ -1,14 +1,22 @@
 
 import unittest
 import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
 from io import BytesIO
+from unittest import mock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
 
 # プロジェクトルートをパスに追加
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from app import create_app, db
-from app.models import Part, Tag
+from app.models import Part, Tag, PartTombstone, ImportJob, part_tag
 
 class BasicTests(unittest.TestCase):
 
@@ -171,5 +179,280 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'\xe3\x83\x95\xe3\x82\xa1\xe3\x82\xa4\xe3\x83\xab\xe3\x81\x8c\xe3\x81\x82\xe3\x82\x8a\xe3\x81\xbe\xe3\x81\x9b\xe3\x82\x93', response.data) # b'ファイルがありません'
 
+    def test_changes_feed_initial_sync(self):
+        """変更フィードで全件を取得できることをテスト"""
+        tag = Tag(name='SMD')
+        db.session.add(tag)
+        db.session.add(Part(name='Feed Part', quantity=3, tags=[tag]))
+        db.session.commit()
+
+        response = self.client.get('/changes')
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        self.assertEqual(len(data['changes']), 1)
+        self.assertEqual(data['changes'][0]['type'], 'upsert')
+        self.assertEqual(data['changes'][0]['part']['name'], 'Feed Part')
+        self.assertEqual(data['changes'][0]['part']['tags'], ['SMD'])
+        self.assertFalse(data['has_more'])
+
+    def test_changes_feed_since_cursor(self):
+        """カーソル以降の変更と削除だけが返ることをテスト"""
+        keep = Part(name='Keep', quantity=1)
+        edit = Part(name='Edit', quantity=1)
+        drop = Part(name='Drop', quantity=1)
+        db.session.add_all([keep, edit, drop])
+        db.session.commit()
+        cursor = self.client.get('/changes').get_json()['next_cursor']
+
+        edit.quantity = 5
+        db.session.commit()
+        drop_id = drop.id
+        db.session.delete(drop)
+        db.session.commit()
+        self.assertIsNotNone(PartTombstone.query.filter_by(part_id=drop_id).first())
+
+        data = self.client.get(f'/changes?since={cursor}').get_json()
+        changes = data['changes']
+        self.assertEqual([c['type'] for c in changes], ['upsert', 'delete'])
+        self.assertEqual(changes[0]['part']['quantity'], 5)
+        self.assertEqual(changes[1]['id'], drop_id)
+
+        data = self.client.get(f"/changes?since={data['next_cursor']}").get_json()
+        self.assertEqual(data['changes'], [])
+
+    def test_changes_feed_paging(self):
+        """limit 指定でページ分割されることをテスト"""
+        db.session.add_all([Part(name=f'Page {i}', quantity=i) for i in range(5)])
+        db.session.commit()
+
+        names = []
+        cursor = ''
+        while True:
+            data = self.client.get(f'/changes?since={cursor}&limit=2').get_json()
+            names += [c['part']['name'] for c in data['changes']]
+            cursor = data['next_cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(sorted(names), [f'Page {i}' for i in range(5)])
+
+    def test_changes_feed_invalid_cursor(self):
+        """不正なカーソルで400が返ることをテスト"""
+        response = self.client.get('/changes?since=abc')
+        self.assertEqual(response.status_code, 400)
+
+    def test_revisions_unique_for_overlapping_writers(self):
+        """同時に書き込む2つのセッションに別々のリビジョンが、コミット順に振られることをテスト"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine(f'sqlite:///{os.path.join(tmp_dir, "parts.db")}')
+            db.metadata.create_all(engine)
+            first = Session(engine)
+            second = Session(engine)
+
+            first.add(Part(name='First Writer', quantity=1))
+            first.flush()  # トランザクションを開いたまま保持する
+
+            def write_second():
+                second.add(Part(name='Second Writer', quantity=1))
+                second.commit()
+
+            writer = threading.Thread(target=write_second)
+            writer.start()
+            time.sleep(0.2)  # 2つ目の書き込みを1つ目と重ならせる
+            first.commit()
+            writer.join()
+
+            with Session(engine) as check:
+                revisions = dict(check.query(Part.name, Part.revision).all())
+            first.close()
+            second.close()
+            engine.dispose()
+        self.assertLess(revisions['First Writer'], revisions['Second Writer'])
+
+    def test_bulk_add_tags(self):
+        """選択した部品にタグを一括付与できることをテスト（重複なし）"""
+        tag = Tag(name='Bulk')
+        part1 = Part(name='Bulk 1', quantity=1, tags=[tag])
+        part2 = Part(name='Bulk 2', quantity=1)
+        db.session.add_all([tag, part1, part2])
+        db.session.commit()
+        revision = part1.revision
+
+        response = self.client.post('/parts/tags/bulk', data=dict(
+            action='add',
+            part_ids=[str(part1.id), str(part2.id)],
+            tag_ids=[str(tag.id)]
+        ), follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(db.session.query(part_tag).filter_by(tag_id=tag.id).count(), 2)
+        self.assertIn(tag, part2.tags)
+        # 既に付いていた部品のリビジョンは変わらない
+        self.assertEqual(part1.revision, revision)
+        self.assertGreater(part2.revision, revision)
+
+    def test_bulk_remove_tags(self):
+        """選択した部品からタグを一括解除できることをテスト"""
+        keep = Tag(name='Keep')
+        drop = Tag(name='Drop')
+        part = Part(name='Bulk Remove', quantity=1, tags=[keep, drop])
+        db.session.add(part)
+        db.session.commit()
+
+        self.client.post('/parts/tags/bulk', data=dict(
+            action='remove',
+            part_ids=[str(part.id)],
+            tag_ids=[str(drop.id)]
+        ), follow_redirects=True)
+        self.assertEqual(part.tags, [keep])
+
+    def test_merge_tags(self):
+        """タグを統合すると関連付けが付け替えられ、元のタグが削除されることをテスト"""
+        source = Tag(name='resistor')
+        target = Tag(name='Resistor')
+        both = Part(name='Both', quantity=1, tags=[source, target])
+        only_source = Part(name='Only Source', quantity=1, tags=[source])
+        db.session.add_all([both, only_source])
+        db.session.commit()
+        source_id = source.id
+
+        response = self.client.post(f'/tags/{source_id}/merge', data=dict(target_id=target.id), follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(db.session.get(Tag, source_id))
+        self.assertEqual(both.tags, [target])
+        self.assertEqual(only_source.tags, [target])
+        self.assertEqual(db.session.query(part_tag).filter_by(tag_id=target.id).count(), 2)
+
+    def test_upload_csv_row_errors(self):
+        """不正な行はスキップされ、ジョブのエラーとして記録されることをテスト"""
+        csv_content = (
+            b'name,category,package,quantity,location,note,tags\n'
+            b'Good Part,Resistor,1/4W,10,Box A,,\n'
+            b'Bad Part,Resistor,1/4W,many,Box A,,\n'
+        )
+        data = {'csv_file': (BytesIO(csv_content), 'test.csv')}
+        response = self.client.post('/parts/upload', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/parts/upload/jobs/', response.headers['Location'])
+
+        job = ImportJob.query.one()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.rows_done, 1)
+        self.assertEqual(job.error_count, 1)
+        self.assertIsNotNone(Part.query.filter_by(name='Good Part').first())
+        self.assertIsNone(Part.query.filter_by(name='Bad Part').first())
+
+        response = self.client.get(response.headers['Location'])
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('3行目'.encode('utf-8'), response.data)
+
+    def test_upload_csv_background_job(self):
+        """バックグラウンドジョブで取り込み、進捗を取得できることをテスト"""
+        self.app.config['CSV_IMPORT_ASYNC'] = True
+        csv_content = b'name,quantity,tags\n' + b''.join(
+            f'Async Part {i},{i},async\n'.encode() for i in range(5))
+        data = {'csv_file': (BytesIO(csv_content), 'test.csv')}
+        response = self.client.post('/parts/upload', data=data, content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 302)
+
+        job_id = ImportJob.query.one().id
+        for _ in range(100):
+            status = self.client.get(f'/parts/upload/jobs/{job_id}/status').get_json()
+            if status['status'] in ('done', 'failed', 'cancelled'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['rows_done'], 5)
+        self.assertEqual(status['processed_bytes'], status['total_bytes'])
+        self.assertEqual(len(Tag.query.filter_by(name='async').one().parts), 5)
+
+    def test_cancel_import_job(self):
+        """未完了のジョブにキャンセルを要求できることをテスト"""
+        job = ImportJob(filename='big.csv', status='running')
+        db.session.add(job)
+        db.session.commit()
+
+        response = self.client.post(f'/parts/upload/jobs/{job.id}/cancel', follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(db.session.get(ImportJob, job.id).cancel_requested)
+
+    def test_upload_csv_error_line_number_with_multiline_field(self):
+        """改行を含むフィールドがあっても、エラーの行番号が実際の行を指すことをテスト"""
+        csv_content = (
+            b'name,quantity,note\n'
+            b'Multi Line,1,"line1\nline2"\n'
+            b'Bad Part,many,\n'
+        )
+        data = {'csv_file': (BytesIO(csv_content), 'test.csv')}
+        self.client.post('/parts/upload', data=data, content_type='multipart/form-data')
+        job = ImportJob.query.one()
+        self.assertEqual(job.error_messages, ['4行目: 在庫数が不正です (many)'])
+
+    def test_upload_csv_removes_qr_codes_of_failed_batch(self):
+        """QRコード生成中に失敗したバッチの画像が削除されることをテスト"""
+        from app import csv_import
+        original_save = csv_import.save_qr_code
+        saved = []
+
+        def failing_save(part):
+            if saved:
+                raise RuntimeError('disk full')
+            path = original_save(part)
+            saved.append(path)
+            return path
+
+        csv_content = b'name,quantity\nQR 1,1\nQR 2,1\n'
+        data = {'csv_file': (BytesIO(csv_content), 'test.csv')}
+        with mock.patch.object(csv_import, 'save_qr_code', side_effect=failing_save):
+            self.client.post('/parts/upload', data=data, content_type='multipart/form-data')
+
+        job = ImportJob.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(len(saved), 1)
+        self.assertFalse(os.path.exists(saved[0]))
+
+    def test_stale_import_job_is_failed(self):
+        """ハートビートが途絶えたジョブが失敗扱いになり、一時ファイルが削除されることをテスト"""
+        fd, spool_path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        job = ImportJob(filename='big.csv', status='running', spool_path=spool_path,
+                        updated_at=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(job)
+        db.session.commit()
+
+        status = self.client.get(f'/parts/upload/jobs/{job.id}/status').get_json()
+        self.assertEqual(status['status'], 'failed')
+        self.assertIsNotNone(status['finished_at'])
+        self.assertFalse(os.path.exists(spool_path))
+
+        self.client.post(f'/parts/upload/jobs/{job.id}/cancel')
+        self.assertFalse(db.session.get(ImportJob, job.id).cancel_requested)
+
+    def test_secret_key_shared_between_apps(self):
+        """create_app ごと（ワーカーごと）に同じ秘密鍵が使われ、鍵ファイルは一度だけ作られることをテスト"""
+        with tempfile.TemporaryDirectory() as instance_path, \
+                mock.patch.dict(os.environ):
+            os.environ.pop('FLASK_SECRET_KEY', None)
+            key_path = os.path.join(instance_path, 'secret_key')
+
+            key = create_app(instance_path=instance_path).secret_key
+            self.assertTrue(key)
+            mtime = os.stat(key_path).st_mtime_ns
+            self.assertEqual(create_app(instance_path=instance_path).secret_key, key)
+            self.assertEqual(os.stat(key_path).st_mtime_ns, mtime)
+            self.assertEqual(os.listdir(instance_path), ['secret_key'])
+            if os.name == 'posix':
+                self.assertEqual(os.stat(key_path).st_mode & 0o777, 0o600)
+
+    def test_create_app_does_not_import_heavy_modules(self):
+        """起動時に qrcode / Pillow / alembic を読み込まないことをテスト"""
+        script = (
+            'import sys; from app import create_app; create_app(); '
+            'print(",".join(m for m in ("qrcode", "PIL", "alembic") if m in sys.modules))'
+        )
+        result = subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(self.app.root_path), capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(result.stdout.strip(), '')
+
 if __name__ == '__main__':
     unittest.main()